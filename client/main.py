@@ -1,16 +1,93 @@
 import asyncio
+import json
+import sys
+import time
+from collections.abc import Callable
 from contextlib import AsyncExitStack
-from typing import Optional
+from typing import Any, Optional
 
-from anthropic import Anthropic
+from anthropic import AsyncAnthropic
+from anthropic.types import Message
 from dotenv import load_dotenv
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
-from pydantic import validate_call
+from mcp.client.streamable_http import streamablehttp_client
+
+try:
+    import uvloop
+except ImportError:  # uvloop は Windows では使えない
+    uvloop = None
 
 # .envから環境変数をロードする
 load_dotenv()
 
+# サーバースクリプトの拡張子 -> 起動コマンド
+SERVER_COMMANDS = {
+    "py": "python",
+    "js": "node",
+}
+
+# 使用するClaudeのモデル
+MODEL = "claude-3-5-sonnet-20241022"
+
+# Anthropic プロンプトキャッシュを有効にするヘッダ
+PROMPT_CACHING_HEADERS = {"anthropic-beta": "prompt-caching-2024-07-31"}
+
+# tool call 結果のキャッシュ有効期間 (秒)
+# .. アラートは変化が速く、予報は比較的ゆっくり更新される
+TOOL_CACHE_TTL = {
+    "get_alerts": 60.0,
+    "get_forecast": 600.0,
+}
+DEFAULT_TOOL_CACHE_TTL = 60.0
+
+
+def with_cache_breakpoint(messages: list[dict]) -> list[dict]:
+    """最後のメッセージにプロンプトキャッシュのブレークポイントを付ける
+
+    会話履歴の先頭部分をキャッシュし、tool call が続いても毎回
+    全履歴を処理し直さないようにする。ブレークポイントの数には上限があるため、
+    履歴自体は変更せずにコピーを返す
+
+    Args:
+        messages: Claudeに渡す会話履歴 (最後はユーザのメッセージ)
+    """
+    *history, last = messages
+    content = last["content"]
+
+    if isinstance(content, str):
+        content = [{"type": "text", "text": content}]
+
+    content = [
+        *content[:-1],
+        {**content[-1], "cache_control": {"type": "ephemeral"}},
+    ]
+
+    return [*history, {**last, "content": content}]
+
+
+def tool_result(tool_use_id: str, result: Any) -> dict:
+    """tool call の結果を tool_result ブロックに変換する
+
+    Args:
+        tool_use_id: 対応する tool_use ブロックのID
+        result: tool call の結果、または tool call で発生した例外
+    """
+    if isinstance(result, BaseException):
+        return {
+            "type": "tool_result",
+            "tool_use_id": tool_use_id,
+            "content": f"ツールの実行に失敗しました: {result}",
+            "is_error": True,
+        }
+
+    return {
+        "type": "tool_result",
+        "tool_use_id": tool_use_id,
+        "content": result.content,
+        "is_error": result.isError,
+    }
+
 
 class MCPClient:
     """Weather API MCPサーバ にリクエストを送るクライアント"""
@@ -18,55 +95,165 @@ class MCPClient:
     def __init__(self) -> None:
         self.session: Optional[ClientSession] = None
         self.exit_stack = AsyncExitStack()
-        self.anthropic = Anthropic()
+        self.anthropic = AsyncAnthropic()
+        self.available_tools: list[dict] = []
+        self._tool_cache: dict[tuple[str, str], tuple[float, Any]] = {}
 
-    @validate_call
     async def connect_to_server(self, server_script_path: str):
         """MCPサーバーに接続する
 
         Args:
-            server_script_path: サーバースクリプトへのパス (.py または .js)
+            server_script_path: サーバースクリプトへのパス (.py または .js)、
+                または起動済みサーバーのURL (http:// または https://)
         """
-        is_python = server_script_path.endswith(".py")
-        is_js = server_script_path.endswith(".js")
-
-        if not (is_python or is_js):
-            raise ValueError(
-                "サーバースクリプトは .py または .js ファイルでなければなりません。"
+        if server_script_path.startswith(("http://", "https://")):
+            # 起動済みのサーバーに接続する
+            # .. クライアント起動の度にサーバープロセスを立ち上げるコストを省く
+            http_transport = await self.exit_stack.enter_async_context(
+                streamablehttp_client(server_script_path)
             )
+            self.read_stream, self.write_stream, _ = http_transport
 
-        command = "python" if is_python else "node"
+        else:
+            command = SERVER_COMMANDS.get(server_script_path.rpartition(".")[2])
 
-        server_params = StdioServerParameters(
-            command=command, args=[server_script_path], env=None
-        )
+            if command is None:
+                raise ValueError(
+                    "サーバースクリプトは .py または .js ファイルでなければなりません。"
+                )
+
+            server_params = StdioServerParameters(
+                command=command, args=[server_script_path], env=None
+            )
+
+            stdio_transport = await self.exit_stack.enter_async_context(
+                stdio_client(server_params)
+            )
+            self.read_stream, self.write_stream = stdio_transport
 
-        stdio_transport = await self.exit_stack.enter_async_context(
-            stdio_client(server_params)
-        )
-        self.stdio, self.write = stdio_transport
         self.session = await self.exit_stack.enter_async_context(
-            ClientSession(self.stdio, self.write)
+            ClientSession(self.read_stream, self.write_stream)
         )
 
         await self.session.initialize()
 
         # 使用可能なツールのリストを取得、表示
+        # .. ツールはセッション中に変わらないため、ここで一度だけ取得して保持する
         response = await self.session.list_tools()
         tools = response.tools
 
+        self.available_tools = [
+            {
+                "name": tool.name,
+                "description": tool.description,
+                "input_schema": tool.inputSchema,
+            }
+            for tool in tools
+        ]
+
+        # ツール定義はプロンプトキャッシュの対象にする
+        # .. 最後のツールに cache_control を付けると、それ以前の全ツールがキャッシュされる
+        if self.available_tools:
+            self.available_tools[-1]["cache_control"] = {"type": "ephemeral"}
+
         print(
             "\nツールでMCPサーバーにリクエストを送信できます:",
             [tool.name for tool in tools],
         )
 
-    @validate_call
-    async def process_query(self, query: str) -> str:
+    async def call_tool(self, tool_name: str, tool_args: dict) -> Any:
+        """tool call を実行する (同一引数の結果はTTLの間キャッシュする)
+
+        Args:
+            tool_name: ツール名
+            tool_args: ツールに渡す引数
+        """
+        key = (tool_name, json.dumps(tool_args, sort_keys=True))
+        now = time.monotonic()
+
+        cached = self._tool_cache.get(key)
+        if cached is not None and cached[0] > now:
+            return cached[1]
+
+        result = await self.session.call_tool(tool_name, tool_args)
+
+        # エラー結果はキャッシュしない
+        if not result.isError:
+            ttl = TOOL_CACHE_TTL.get(tool_name, DEFAULT_TOOL_CACHE_TTL)
+            self._tool_cache[key] = (now + ttl, result)
+
+        return result
+
+    async def create_message(
+        self,
+        messages: list[dict],
+        on_text: Optional[Callable[[str], None]] = None,
+        dispatch_tools: bool = True,
+    ) -> tuple[Message, dict[str, asyncio.Task]]:
+        """Claudeの返答をストリーミングで受け取る
+
+        tool_use ブロックが確定した時点で tool call を開始し、
+        残りの返答の受信と並行して実行する
+
+        Args:
+            messages: Claudeに渡す会話履歴
+            on_text: テキストの差分を受け取るコールバック
+            dispatch_tools: False の場合は tool call を開始しない
+
+        Return:
+            最終的な返答と、tool_use_id をキーにした tool call のタスク
+        """
+        tool_tasks: dict[str, asyncio.Task] = {}
+
+        try:
+            async with self.anthropic.messages.stream(
+                model=MODEL,
+                max_tokens=1000,
+                messages=with_cache_breakpoint(messages),
+                tools=self.available_tools,
+                extra_headers=PROMPT_CACHING_HEADERS,
+            ) as stream:
+                async for event in stream:
+                    if event.type == "text":
+                        if on_text:
+                            on_text(event.text)
+
+                    elif (
+                        dispatch_tools
+                        and event.type == "content_block_stop"
+                        and event.content_block.type == "tool_use"
+                    ):
+                        block = event.content_block
+                        tool_tasks[block.id] = asyncio.create_task(
+                            self.call_tool(block.name, block.input)
+                        )
+
+                response = await stream.get_final_message()
+
+        except BaseException:
+            # ストリームが途中で失敗した場合、開始済みの tool call を放置しない
+            for task in tool_tasks.values():
+                task.cancel()
+            raise
+
+        return response, tool_tasks
+
+    async def process_query(
+        self,
+        query: str,
+        on_text: Optional[Callable[[str], None]] = None,
+    ) -> str:
         """Claudeと利用可能なMツールを使用してクエリを処理する
 
         Args:
             query: ユーザが入力した文字列
+            on_text: 返答テキストを受信した順に受け取るコールバック
         """
+
+        def emit(text: str) -> None:
+            if on_text:
+                on_text(text)
+
         messages = [
             {
                 "role": "user",
@@ -74,75 +261,60 @@ class MCPClient:
             }
         ]
 
-        response = await self.session.list_tools()
-
-        available_tools = [
-            {
-                "name": tool.name,
-                "description": tool.description,
-                "input_schema": tool.inputSchema,
-            }
-            for tool in response.tools
-        ]
-
         # Claudeの初期化
         # .. MCPサーバで使える機能 (tools)
         # .. ユーザが入力した文字列 を渡す
-        response = self.anthropic.messages.create(
-            model="claude-3-5-sonnet-20241022",
-            max_tokens=1000,
-            messages=messages,
-            tools=available_tools,
-        )
+        response, tool_tasks = await self.create_message(messages, emit)
 
         # レスポンス処理とtool callsの処理
         final_text = []
-        assistant_message_content = []
+        tool_uses = []
 
         for content in response.content:
             if content.type == "text":
                 final_text.append(content.text)
-                assistant_message_content.append(content)
 
             elif content.type == "tool_use":
-                tool_name = content.name
-                tool_args = content.input
-
-                # tool call の実行
-                result = await self.session.call_tool(tool_name, tool_args)
-                final_text.append(f"[Calling tool {tool_name} with args {tool_args}]")
-
-                assistant_message_content.append(content)
+                tool_uses.append(content)
+                notice = f"[Calling tool {content.name} with args {content.input}]"
+                final_text.append(notice)
+                emit(f"\n{notice}\n")
+
+        if tool_uses:
+            # 全ての tool call の結果をまとめて待つ (ストリーミング中に並行して開始済み)
+            # .. 失敗した tool call があっても他の結果は待ち、失敗はエラーとしてClaudeに返す
+            results = await asyncio.gather(
+                *(tool_tasks[content.id] for content in tool_uses),
+                return_exceptions=True,
+            )
 
-                messages.append(
-                    {
-                        "role": "assistant",
-                        "content": assistant_message_content,
-                    }
-                )
+            messages.append(
+                {
+                    "role": "assistant",
+                    "content": response.content,
+                }
+            )
 
-                messages.append(
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "tool_result",
-                                "tool_use_id": content.id,
-                                "content": result.content,
-                            }
-                        ],
-                    }
-                )
+            # tool call の結果は1つのメッセージにまとめて返す
+            messages.append(
+                {
+                    "role": "user",
+                    "content": [
+                        tool_result(content.id, result)
+                        for content, result in zip(tool_uses, results)
+                    ],
+                }
+            )
 
-                # Claudeから次の返答を得る
-                response = self.anthropic.messages.create(
-                    model="claude-3-5-sonnet-20241022",
-                    max_tokens=1000,
-                    messages=messages,
-                    tools=available_tools,
-                )
+            # Claudeから次の返答を得る
+            # .. 次の返答で要求された tool call はここでは扱わないため開始しない
+            response, _ = await self.create_message(
+                messages, emit, dispatch_tools=False
+            )
 
-                final_text.append(response.content[0].text)
+            final_text.extend(
+                block.text for block in response.content if block.type == "text"
+            )
 
         return "\n".join(final_text)
 
@@ -153,13 +325,18 @@ class MCPClient:
 
         while True:
             try:
-                query = input("\nQuery: ").strip()
+                # input() はイベントループを止めるため別スレッドで待つ
+                query = (await asyncio.to_thread(input, "\nQuery: ")).strip()
 
                 if query.lower() == "quit":
                     break
 
-                response = await self.process_query(query)
-                print("\n" + response)
+                # 返答は受信した順にそのまま表示する
+                print()
+                await self.process_query(
+                    query, on_text=lambda text: print(text, end="", flush=True)
+                )
+                print()
 
             except Exception as e:
                 print(f"\nエラー: {str(e)}")
@@ -171,7 +348,7 @@ class MCPClient:
 
 async def main():
     if len(sys.argv) < 2:
-        print("Usage: python client.py <path_to_server_script>")
+        print("Usage: python client.py <path_to_server_script | server_url>")
         sys.exit(1)
 
     client = MCPClient()
@@ -184,6 +361,8 @@ async def main():
 
 
 if __name__ == "__main__":
-    import sys
-
-    asyncio.run(main())
+    # 利用可能なら uvloop のイベントループで実行する
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
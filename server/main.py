@@ -1,50 +1,267 @@
+import asyncio
+import io
+import os
+import sqlite3
+import sys
+from collections import OrderedDict
+from itertools import islice
+from pathlib import Path
 from typing import Any
+import anyio
 import httpx
+import orjson
 from mcp.server.fastmcp import FastMCP
 from pydantic import validate_call
 
-
-#  FastMCP サーバの初期化
-mcp = FastMCP("weather")
+try:
+    import uvloop
+except ImportError:  # uvloop は Windows では使えない
+    uvloop = None
 
 
 WEATHER_API_BASE = "https://api.weather.gov"
 USER_AGENT = "weather-app/1.0"
 
+# get_forecast で表示する予報の期間数
+FORECAST_PERIODS = 5
+
+
+# NWS API 用の共有クライアント
+# .. リクエスト毎の TCP/TLS ハンドシェイクを避けるためコネクションを使い回す
+# .. HTTP/2 で同じホストへの並行リクエストを1つのコネクションに多重化する
+_client = httpx.AsyncClient(
+    base_url=WEATHER_API_BASE,
+    http2=True,
+    headers={
+        "User-Agent": USER_AGENT,
+        "Accept": "application/geo+json"
+    },
+    timeout=30.0,
+    limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+)
+
+
+# 座標 -> 予報URL のキャッシュ
+# .. /points の結果はグリッドが変わらない限り不変なので、2回目以降は問い合わせを省略する
+FORECAST_URL_CACHE_SIZE = 1024
+_forecast_url_cache: OrderedDict[tuple[float, float], str] = OrderedDict()
+
+# 座標 -> 予報URL の永続キャッシュ
+# .. サーバーを再起動しても既知の座標では /points の問い合わせを省略する
+# .. 保存先は環境変数 NWS_POINTS_CACHE で変更できる (空文字列で無効)
+POINTS_CACHE_PATH = os.environ.get(
+    "NWS_POINTS_CACHE", str(Path(__file__).with_name("nws_points.db"))
+)
+_points_db: sqlite3.Connection | None = None
+_points_db_disabled = not POINTS_CACHE_PATH
+
+
+#  FastMCP サーバの初期化
+mcp = FastMCP("weather")
+
 
-@validate_call
 async def make_nws_request(url: str) -> dict[str, Any] | None:
     """ 適切なエラーハンドリングでNWS APIにリクエストを出す
+
+    Args:
+        url: WEATHER_API_BASE からのパス、または絶対URL
     """
-    headers = {
-        "User-Agent": USER_AGENT,
-        "Accept": "application/geo+json"
-    }
+    try:
+        response = await _client.get(url)
+        response.raise_for_status()
+        # 大きな GeoJSON を高速にパースするため orjson を使う
+        return orjson.loads(response.content)
+    except Exception:
+        return None
+
 
-    async with httpx.AsyncClient() as client:
+def get_points_db() -> sqlite3.Connection | None:
+    """永続キャッシュのDBを開く
+
+    初回の呼び出し時に開き、開けない場合は None を返してメモリ上のキャッシュのみ使う
+    """
+    global _points_db, _points_db_disabled
+
+    if _points_db is None and not _points_db_disabled:
         try:
-            response = await client.get(url, headers=headers, timeout=30.0)
-            response.raise_for_status()
-            return response.json()
-        except Exception:
+            db = sqlite3.connect(POINTS_CACHE_PATH, isolation_level=None)
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS points"
+                " (key TEXT PRIMARY KEY, forecast_url TEXT)"
+            )
+        except sqlite3.Error:
+            _points_db_disabled = True
+        else:
+            _points_db = db
+
+    return _points_db
+
+
+def load_forecast_url(db_key: str) -> str | None:
+    """永続キャッシュから予報URLを読み込む
+    """
+    db = get_points_db()
+    if db is None:
+        return None
+
+    try:
+        row = db.execute(
+            "SELECT forecast_url FROM points WHERE key = ?", (db_key,)
+        ).fetchone()
+    except sqlite3.Error:
+        return None
+
+    return row[0] if row is not None else None
+
+
+def store_forecast_url(db_key: str, forecast_url: str) -> None:
+    """永続キャッシュに予報URLを保存する
+    """
+    db = get_points_db()
+    if db is None:
+        return
+
+    try:
+        db.execute(
+            "INSERT OR REPLACE INTO points (key, forecast_url) VALUES (?, ?)",
+            (db_key, forecast_url),
+        )
+    except sqlite3.Error:
+        pass
+
+
+def delete_forecast_url(db_key: str) -> None:
+    """永続キャッシュから予報URLを削除する
+    """
+    db = get_points_db()
+    if db is None:
+        return
+
+    try:
+        db.execute("DELETE FROM points WHERE key = ?", (db_key,))
+    except sqlite3.Error:
+        pass
+
+
+def points_key(latitude: float, longitude: float) -> tuple[float, float]:
+    """座標をキャッシュのキーに変換する
+
+    NWS API は小数点以下4桁までしか受け付けないため、丸めた値をキーにする
+    """
+    return (round(latitude, 4), round(longitude, 4))
+
+
+def forget_forecast_url(latitude: float, longitude: float) -> None:
+    """座標に対応する予報URLを両方のキャッシュから削除する
+
+    Args:
+        latitude: 緯度
+        longitude: 経度
+    """
+    key = points_key(latitude, longitude)
+
+    _forecast_url_cache.pop(key, None)
+    delete_forecast_url(f"{key[0]},{key[1]}")
+
+
+async def get_forecast_url(latitude: float, longitude: float) -> str | None:
+    """座標に対応する予報URLを取得する (LRU・SQLiteキャッシュ付き)
+
+    Args:
+        latitude: 緯度
+        longitude: 経度
+    """
+    key = points_key(latitude, longitude)
+
+    forecast_url = _forecast_url_cache.get(key)
+    if forecast_url is not None:
+        _forecast_url_cache.move_to_end(key)
+        return forecast_url
+
+    db_key = f"{key[0]},{key[1]}"
+    forecast_url = load_forecast_url(db_key)
+
+    if forecast_url is None:
+        # 予測グリッドの終点を取得する
+        points_response_data = await make_nws_request(f"/points/{db_key}")
+
+        if not points_response_data:
             return None
 
+        # ポイントレスポンスから予想URLを取得
+        forecast_url = points_response_data["properties"]["forecast"]
 
-@validate_call
-def format_alert(feature: dict) -> str:
-    """アラート機能を読みやすい文字列に整形する
+        store_forecast_url(db_key, forecast_url)
+
+    _forecast_url_cache[key] = forecast_url
+    if len(_forecast_url_cache) > FORECAST_URL_CACHE_SIZE:
+        _forecast_url_cache.popitem(last=False)
+
+    return forecast_url
+
+
+# アラートの表示項目 (見出し, プロパティ名, 既定の文言)
+ALERT_FIELDS = (
+    ("\nEvent: ", "event", "Unknown"),
+    ("\nArea: ", "areaDesc", "Unknown"),
+    ("\nSeverity: ", "severity", "Unknown"),
+    ("\nDescription: ", "description", "No description available"),
+    ("\nInstructions: ", "instruction", "No specific instructions provided"),
+)
+
+
+def write_alert(buf: io.StringIO, feature: dict) -> None:
+    """アラート機能を読みやすい文字列に整形してバッファに書き込む
     """
     props = feature["properties"]
 
+    for heading, key, default in ALERT_FIELDS:
+        buf.write(heading)
+        buf.write(str(props.get(key, default)))
+
+    buf.write("\n")
+
+
+def format_period(period: dict) -> str:
+    """予報の期間を読みやすい文字列に整形する
+    """
     return f"""
-Event: {props.get('event', 'Unknown')}
-Area: {props.get('areaDesc', 'Unknown')}
-Severity: {props.get('severity', 'Unknown')}
-Description: {props.get('description', 'No description available')}
-Instructions: {props.get('instruction', 'No specific instructions provided')}
+{period['name']}:
+Temperature: {period['temperature']}°{period['temperatureUnit']}
+Wind: {period['windSpeed']} {period['windDirection']}
+Forecast: {period['detailedForecast']}
 """
 
 
+async def fetch_alerts(state: str) -> str:
+    """1つの州の天気予報アラートを取得して整形する
+
+    Args:
+        state: 2文字の米国州コード（例：CA、NY）
+    """
+    if len(state) != 2 or not state.isalpha():
+        return "州コードは2文字のアルファベットで指定してください"
+
+    url = f"/alerts/active/area/{state.upper()}"
+    response_data = await make_nws_request(url)
+
+    if not response_data or "features" not in response_data:
+        return "アラートを取得できない、またはアラートが見つからない"
+
+    elif not response_data["features"]:
+        return "この状態に対するアクティブなアラートはありません"
+
+    # 中間の文字列リストを作らず、1つのバッファに順に書き込む
+    buf = io.StringIO()
+
+    for i, feature in enumerate(response_data["features"]):
+        if i:
+            buf.write("\n---\n")
+        write_alert(buf, feature)
+
+    return buf.getvalue()
+
+
 @validate_call
 @mcp.tool()
 async def get_alerts(state: str) -> str:
@@ -56,18 +273,31 @@ async def get_alerts(state: str) -> str:
     Return:
         天気予報アラート文字列
     """
-    url = f"{WEATHER_API_BASE}/alerts/active/area/{state}"
-    response_data = await make_nws_request(url)
+    return await fetch_alerts(state)
 
-    if not response_data or "features" not in response_data:
-        return "アラートを取得できない、またはアラートが見つからない"
 
-    elif not response_data["features"]:
-        return "この状態に対するアクティブなアラートはありません"
+@validate_call
+@mcp.tool()
+async def get_alerts_multi(states: list[str]) -> str:
+    """複数の米国州の天気予報アラートをまとめて受け取る
 
-    alerts = [format_alert(feature) for feature in response_data["features"]]
+    複数の州について尋ねられた場合は、get_alerts を州ごとに呼ぶ代わりにこちらを使う
+
+    Args:
+        states: 2文字の米国州コードのリスト（例：["CA", "OR", "WA"]）
+
+    Return:
+        州ごとの天気予報アラート文字列
+    """
+    if not states:
+        return "州コードを1つ以上指定してください"
 
-    return "\n---\n".join(alerts)
+    # 各州のリクエストを共有クライアント上で並行して実行する
+    results = await asyncio.gather(*(fetch_alerts(state) for state in states))
+
+    return "\n\n".join(
+        f"=== {state.upper()} ===\n{alerts}" for state, alerts in zip(states, results)
+    )
 
 
 @validate_call
@@ -79,38 +309,59 @@ async def get_forecast(latitude: float, longitude: float) -> str:
         latitude: 緯度
         longitude: 経度
     """
-    # 予測グリッドの終点を取得する
-    points_url = f"{WEATHER_API_BASE}/points/{latitude},{longitude}"
-    points_response_data = await make_nws_request(points_url)
+    forecast_url = await get_forecast_url(latitude, longitude)
 
-    if not points_response_data:
+    if not forecast_url:
         return "この場所の予報データを取得できません"
 
-    # ポイントレスポンスから予想URLを取得
-    forecast_url = points_response_data["properties"]["forecast"]
     forecast_response_data = await make_nws_request(forecast_url)
 
     if not forecast_response_data:
+        # キャッシュした予報URLが無効になっている可能性があるため、破棄して取り直す
+        forget_forecast_url(latitude, longitude)
+        forecast_url = await get_forecast_url(latitude, longitude)
+
+        if forecast_url:
+            forecast_response_data = await make_nws_request(forecast_url)
+
+    if not forecast_response_data:
+        # 取り直した予報URLも使えない場合は、次回も /points から問い合わせる
+        forget_forecast_url(latitude, longitude)
         return "詳細な予測を取得できない"
 
     # 期間を読みやすい予測にフォーマットする
     periods = forecast_response_data["properties"]["periods"]
 
-    forecasts = []
+    # 次の5つのデータのみ表示 (残りの期間は整形しない)
+    return "\n---\n".join(
+        format_period(period) for period in islice(periods, FORECAST_PERIODS)
+    )
 
-    for period in periods[:5]:  # 次の5つのデータのみ表示
-        forecast = f"""
-{period['name']}:
-Temperature: {period['temperature']}°{period['temperatureUnit']}
-Wind: {period['windSpeed']} {period['windDirection']}
-Forecast: {period['detailedForecast']}
-"""
-        forecasts.append(forecast)
 
-    return "\n---\n".join(forecasts)
+async def serve(transport: str) -> None:
+    """サーバーを実行し、終了時に共有クライアントを閉じる
+
+    Args:
+        transport: "stdio" または "streamable-http"
+    """
+    # streamable-http ではセッション毎に lifespan が実行されるため、
+    # 共有クライアントはサーバー全体の実行に合わせて閉じる
+    async with _client:
+        if transport == "streamable-http":
+            await mcp.run_streamable_http_async()
+        else:
+            await mcp.run_stdio_async()
 
 
 if __name__ == "__main__":
 
     # サーバーの初期化と実行
-    mcp.run(transport='stdio')
+    # .. 引数に streamable-http を渡すと常駐サーバーとして起動し、複数のクライアントから接続できる
+    transport = sys.argv[1] if len(sys.argv) > 1 else "stdio"
+
+    if transport not in ("stdio", "streamable-http"):
+        print("Usage: python main.py [stdio | streamable-http]")
+        sys.exit(1)
+
+    # 利用可能なら uvloop のイベントループを使う
+    anyio.run(serve, transport, backend_options={"use_uvloop": uvloop is not None})